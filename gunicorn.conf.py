@@ -4,8 +4,12 @@ import os
 # Gunicorn configuration
 bind = "0.0.0.0:10000"
 workers = 2  # Reduced number of workers for free tier
-worker_class = "sync"
-worker_connections = 50
+# The app is I/O bound (one MongoDB round-trip per request), so use gevent
+# workers to multiplex many in-flight requests per process. The gevent worker
+# monkey-patches the stdlib before loading the app (preload_app is off), so
+# pymongo picks up the cooperative socket/threading modules.
+worker_class = "gevent"
+worker_connections = 1000
 timeout = 30
 keepalive = 2
 
@@ -28,6 +32,16 @@ daemon = False
 def post_fork(server, worker):
     server.log.info("Worker spawned (pid: %s)", worker.pid)
 
+def post_worker_init(worker):
+    # Create each worker's MongoDB client (and resolve the SRV record) at startup
+    # rather than on its first request; sockets open lazily on the first query.
+    # This runs after the gevent worker has patched the stdlib and loaded the app.
+    from src.app import get_db
+    try:
+        get_db().connect()
+    except Exception as e:
+        worker.log.error("MongoDB connection failed at startup: %s", e)
+
 def pre_fork(server, worker):
     pass
 
@@ -36,6 +50,8 @@ def pre_exec(server):
 
 def worker_int(worker):
     worker.log.info("Worker received INT or QUIT signal")
+    from src.app import get_db
+    get_db().stop_refresher()
 
 def worker_abort(worker):
     worker.log.info("Worker received SIGABRT signal")
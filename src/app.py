@@ -1,13 +1,17 @@
-from flask import Flask, render_template, jsonify, request, current_app, send_from_directory
-from .database import Database
+from flask import Flask, Response, abort, render_template, jsonify, request, current_app, send_from_directory
+from .database import get_database
 import os
 from dotenv import load_dotenv
+from flask_compress import Compress
+import orjson
+import bsonjs
+from bson import json_util
 from functools import wraps
 from time import time
 import logging
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
+# Configure logging (set LOG_LEVEL=WARNING in production to silence per-request logs)
+logging.basicConfig(level=os.getenv('LOG_LEVEL', 'INFO').upper())
 logging.getLogger('pymongo.ocsp_support').setLevel(logging.WARNING)
 logging.getLogger('urllib3.connectionpool').setLevel(logging.WARNING)
 
@@ -25,24 +29,21 @@ if os.environ.get('RENDER'):
 # Configure static files cache
 app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 31536000  # 1 year in seconds
 
-# Database will be initialized lazily by each worker
-db = None
+# Compress JSON and text responses (flask-compress also sets Vary: Accept-Encoding)
+app.config['COMPRESS_MIMETYPES'] = [
+    'application/json',
+    'text/html',
+    'text/css',
+    'application/javascript',
+]
+app.config['COMPRESS_LEVEL'] = 5
+Compress(app)
 
 POSTS_PER_PAGE = 40
 
 def get_db():
-    global db
-    if db is None:
-        db = Database()
-    return db
-
-@app.before_request
-def check_database():
-    try:
-        get_db()
-    except Exception as e:
-        logger.error(f"Database connection error: {str(e)}")
-        return jsonify({"error": "Database connection not available"}), 503
+    # Created lazily by each worker on first use
+    return get_database()
 
 @app.after_request
 def add_cache_headers(response):
@@ -50,6 +51,7 @@ def add_cache_headers(response):
     if request.path.startswith('/static/'):
         response.cache_control.public = True
         response.cache_control.max_age = 31536000  # 1 year
+        response.cache_control.immutable = True
         response.headers['Vary'] = 'Accept-Encoding'
     return response
 
@@ -67,31 +69,82 @@ def timing_decorator(f):
         start = time()
         result = f(*args, **kwargs)
         end = time()
-        logger.info(f'{f.__name__} took {end - start:.2f} seconds')
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(f'{f.__name__} took {end - start:.2f} seconds')
         return result
     return wrapper
 
+def matching_etag(etag):
+    """Return the If-None-Match tag that refers to etag, or None"""
+    # flask-compress appends the encoding (e.g. "...:gzip") to the ETags it sends,
+    # so the tag the client holds is returned as-is for the 304 to echo back
+    for tag in request.if_none_match.as_set(include_weak=True):
+        if tag.split(':', 1)[0] == etag:
+            return tag
+    return None
+
+def encode_files(result):
+    """Encode the /files JSON envelope as a single body"""
+    # Documents are RawBSONDocuments; go from BSON bytes to JSON directly
+    data = b','.join(bsonjs.dumps(doc.raw).encode() for doc in result['data'])
+    # The remaining envelope fields, with the leading "{" swapped for "],"
+    meta = {key: value for key, value in result.items() if key != 'data'}
+    return b'{"data":[' + data + b'],' + orjson.dumps(meta)[1:]
+
 @app.route('/')
 def index():
-    return render_template('index.html')
+    # Inline the requested page so the browser can skip its initial /files request
+    bootstrap_data = None
+    try:
+        page = int(request.args.get('page', 1))
+        if page >= 1:
+            result = get_db().fetch_files(page, POSTS_PER_PAGE)
+            if result['data']:
+                # Decoded to dicts here so the template's tojson filter can escape them
+                bootstrap_data = dict(result, data=[dict(doc) for doc in result['data']])
+    except Exception as e:
+        # The page still works without it; the client falls back to /files
+        logger.error(f'Error preloading files: {str(e)}')
+    return render_template('index.html', bootstrap_data=bootstrap_data)
 
 @app.route('/files')
 @timing_decorator
 def get_files():
     try:
-        page = int(request.args.get('page', 1))
-        logger.debug(f'Requesting page {page}')
-        
-        if page < 1:
-            return jsonify({"error": "Page number must be positive"}), 400
-            
-        result = get_db().fetch_files(page, POSTS_PER_PAGE)
+        after = request.args.get('after')
+        if after is not None:
+            after = int(after)
+            logger.debug(f'Requesting files after {after}')
+            result = get_db().fetch_files_after(after, POSTS_PER_PAGE)
+        else:
+            page = int(request.args.get('page', 1))
+            logger.debug(f'Requesting page {page}')
+
+            if page < 1:
+                return jsonify({"error": "Page number must be positive"}), 400
+
+            # Pages only change when files are added, so the latest number versions them
+            etag = f'{get_db().get_latest_number()}-{page}'
+            matched = matching_etag(etag)
+            if matched is not None:
+                response = current_app.response_class(status=304)
+                response.set_etag(matched)
+                response.cache_control.public = True
+                response.cache_control.max_age = 30
+                return response
+
+            result = get_db().fetch_files(page, POSTS_PER_PAGE)
         
         if not result['data']:
             logger.warning('No data found in database')
             return jsonify({"error": "No files found"}), 404
             
-        return jsonify(result)
+        response = Response(encode_files(result), mimetype='application/json')
+        if after is None:
+            response.set_etag(etag)
+        response.cache_control.public = True
+        response.cache_control.max_age = 30
+        return response
         
     except ValueError as e:
         logger.error(f'Invalid page number: {str(e)}')
@@ -100,5 +153,21 @@ def get_files():
         logger.error(f'Error fetching files: {str(e)}', exc_info=True)
         return jsonify({"error": "Internal server error"}), 500
 
+@app.route('/admin/explain')
+def explain_files():
+    # Development aid: shows whether page queries stay covered by the index
+    if not (app.debug or os.environ.get('ENABLE_ADMIN_ROUTES') == '1'):
+        abort(404)
+
+    try:
+        page = int(request.args.get('page', 1))
+    except ValueError:
+        return jsonify({"error": "Invalid page number"}), 400
+    if page < 1:
+        return jsonify({"error": "Page number must be positive"}), 400
+
+    result = get_db().explain_page(page, POSTS_PER_PAGE)
+    return Response(json_util.dumps(result), mimetype='application/json')
+
 if __name__ == '__main__':
     app.run(debug=True)
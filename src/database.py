@@ -1,73 +1,72 @@
-from pymongo import MongoClient, DESCENDING
-from pymongo.errors import ConnectionFailure, AutoReconnect
+from pymongo import MongoClient, ASCENDING, DESCENDING
+from bson import decode
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+from cachetools import TTLCache
+import msgpack
+import redis
 import os
-from datetime import datetime, timedelta
 import logging
 import time
 import threading
-from functools import wraps
 
 logger = logging.getLogger(__name__)
 
-def with_retry(max_retries=3, delay=1):
-    def decorator(func):
-        @wraps(func)
-        def wrapper(*args, **kwargs):
-            last_error = None
-            for attempt in range(max_retries):
-                try:
-                    return func(*args, **kwargs)
-                except Exception as e:
-                    last_error = e
-                    if attempt < max_retries - 1:
-                        time.sleep(delay * (attempt + 1))
-                        continue
-                    raise last_error
-        return wrapper
-    return decorator
+# Compound index holding every projected field, so page queries are covered
+# (answered from the index alone without fetching the documents)
+_PAGE_INDEX = [
+    ("file_number", DESCENDING),
+    ("file_name", ASCENDING),
+    ("share_link", ASCENDING),
+    ("image_url", ASCENDING),
+    ("file_size", ASCENDING),
+]
+
+# Fields returned for each file; built once rather than per query.
+# A plain dict because pymongo deep-copies it when cloning a cursor.
+_PROJECTION = {
+    "_id": 0,
+    "file_number": 1,
+    "file_name": 1,
+    "share_link": 1,
+    "image_url": 1,
+    "file_size": 1
+}
+_LATEST_PROJECTION = {"_id": 0, "file_number": 1}
+_NEWEST_FIRST = [("file_number", DESCENDING)]
 
-class Database:
-    _instance = None
-    _lock = threading.Lock()
-    _pid = None
-    
-    def __new__(cls):
-        if cls._instance is None or cls._pid != os.getpid():
-            with cls._lock:
-                if cls._instance is None or cls._pid != os.getpid():
-                    cls._instance = super(Database, cls).__new__(cls)
-                    cls._instance._initialized = False
-                    cls._pid = os.getpid()
-        return cls._instance
 
+class Database:
     def __init__(self):
-        if self._initialized and self._pid == os.getpid():
-            return
-            
-        self._initialized = True
         self.client = None
         self.db = None
         self.collection = None
+        self._redis = None
         self._latest_number = None
-        self._cache_time = None
-        self._cache_duration = timedelta(minutes=5)
+        self._cache_deadline = 0.0  # time.monotonic() value after which the count is stale
+        self._cache_duration = 300  # 5 minutes
+        self._page_cache = TTLCache(
+            maxsize=256,
+            ttl=int(os.getenv("PAGE_CACHE_TTL", "60"))
+        )
+        self._page_cache_lock = threading.Lock()
+        self._refresher = None
+        self._stop_refresher = threading.Event()
         
         # Don't initialize connection in __init__
         # Let it be created on first use
 
-    @with_retry(max_retries=3, delay=1)
-    def _ensure_connection(self):
-        """Ensure MongoDB connection exists and is alive"""
-        # Check if we need to create a new connection after fork
-        if self.client is None or self._pid != os.getpid():
-            self._init_connection()
-            return
+    def connect(self):
+        """Open the MongoDB connection for this process ahead of the first request"""
+        self._ensure_connection()
 
-        try:
-            # Quick connection check
-            self.client.admin.command('ping')
-        except Exception as e:
-            logger.warning(f"MongoDB connection check failed: {str(e)}, reconnecting...")
+    def _ensure_connection(self):
+        """Ensure a MongoDB client exists for this process"""
+        # No ping here: pymongo's server monitor heartbeats the topology and
+        # retryReads/retryWrites recover from dropped sockets.
+        # Forked children get a fresh Database (see _reset_after_fork), so
+        # this only has to create the connection on first use.
+        if self.client is None:
             self._init_connection()
 
     def _init_connection(self):
@@ -82,80 +81,341 @@ class Database:
         if not mongo_uri:
             raise ValueError("MONGO_URI environment variable is not set")
 
+        # Pool size is per worker process, so keep
+        #   workers * maxPoolSize <= cluster_connection_limit - headroom
+        # With gevent workers a request holds a connection only for its query,
+        # so 50 covers bursts of in-flight queries on one worker, and keeping
+        # a couple of sockets warm avoids TLS handshakes on the request path.
+        # Override with MONGO_MAX_POOL / MONGO_MIN_POOL to match the cluster tier.
+        max_pool_size = int(os.getenv("MONGO_MAX_POOL", "50"))
+        min_pool_size = int(os.getenv("MONGO_MIN_POOL", "2"))
+
         # Optimized connection settings for Render's free tier
         self.client = MongoClient(
             mongo_uri,
-            maxPoolSize=5,  # Reduced for free tier
-            minPoolSize=0,  # Allow pool to shrink when idle
-            maxIdleTimeMS=30000,  # 30 seconds
+            maxPoolSize=max_pool_size,
+            minPoolSize=min_pool_size,
+            maxConnecting=2,  # Cap concurrent handshakes during bursts
+            maxIdleTimeMS=120000,  # 2 minutes
+            waitQueueTimeoutMS=2000,  # Fail fast when the pool is exhausted
             connectTimeoutMS=5000,
             serverSelectionTimeoutMS=5000,
             retryWrites=True,
             retryReads=True,
-            w='majority',
             socketTimeoutMS=10000,
-            connect=True  # Make immediate connection
+            connect=False  # Connect on the first query instead of blocking here
         )
 
+        # Optional cache shared by all workers; without it each worker only
+        # has its own in-process caches
+        redis_url = os.getenv("REDIS_URL")
+        if redis_url:
+            self._redis = redis.Redis.from_url(
+                redis_url, socket_timeout=0.5, socket_connect_timeout=0.5
+            )
+
         # Initialize database and collection
         self.db = self.client.get_database("telegram_bot_db")
-        self.collection = self.db.get_collection("files")
-        
-        # Update process ID
-        self._pid = os.getpid()
-        
-        # Ensure index exists
-        self.collection.create_index([("file_number", DESCENDING)])
+        # Documents are only passed through to JSON responses, so keep them as
+        # raw BSON instead of decoding every field into Python objects
+        self.collection = self.db.get_collection(
+            "files",
+            codec_options=CodecOptions(document_class=RawBSONDocument)
+        )
+
+        # Index creation is a one-shot deploy step, not something every worker
+        # should repeat on startup
+        if os.getenv("DB_BOOTSTRAP") == "1":
+            self._create_indexes()
         logger.info("Successfully connected to MongoDB and initialized collection")
 
-    @with_retry(max_retries=3, delay=1)
+        self._start_refresher()
+
+    def _start_refresher(self):
+        """Start the thread that keeps the total count fresh off the request path"""
+        # Threads don't survive a fork, so this also restarts it in a new worker
+        if self._refresher is not None and self._refresher.is_alive():
+            return
+        self._stop_refresher.clear()
+        self._refresher = threading.Thread(
+            target=self._refresh_loop,
+            name="total-count-refresher",
+            daemon=True
+        )
+        self._refresher.start()
+
+    def _refresh_loop(self):
+        while not self._stop_refresher.wait(self._refresh_delay()):
+            try:
+                self._refresh_total_count()
+            except Exception as e:
+                logger.warning(f"Background count refresh failed: {str(e)}")
+
+    def _refresh_delay(self):
+        """Seconds until the cached total goes stale"""
+        # A value adopted from Redis is only as fresh as its remaining TTL, so
+        # this is often less than a full interval. The floor paces retries
+        # while refreshes are failing.
+        return max(1.0, self._cache_deadline - time.monotonic())
+
+    def stop_refresher(self):
+        """Stop the background count refresh (e.g. on worker shutdown)"""
+        self._stop_refresher.set()
+
+    def _create_indexes(self):
+        """Create the indexes the page queries are hinted with"""
+        self.collection.create_index(_PAGE_INDEX)
+        logger.info("Ensured covering index on files collection")
+
+    def bootstrap(self):
+        """Connect and create indexes; run once per deploy"""
+        self._ensure_connection()
+        self._create_indexes()
+
+    def get_latest_number(self):
+        """Get the cached total, which only grows as files are added"""
+        self._ensure_connection()
+        return self._get_total_count()
+
     def fetch_files(self, page, posts_per_page):
         """Fetch files with pagination"""
         self._ensure_connection()
         
         total_items = self._get_total_count()
-        logger.info(f"Fetching page {page}, total items: {total_items}")
-        
-        start_number = total_items - (page - 1) * posts_per_page
-        end_number = max(1, start_number - posts_per_page + 1)
-        
-        data = list(
-            self.collection.find(
-                {"file_number": {"$gte": end_number, "$lte": start_number}},
-                {
-                    "_id": 0,
-                    "file_number": 1,
-                    "file_name": 1,
-                    "share_link": 1,
-                    "image_url": 1,
-                    "file_size": 1
-                }
-            ).sort("file_number", -1)
-        )
-        
-        logger.info(f"Found {len(data)} documents for page {page}")
-        if data:
-            logger.info(f"First document in results: {data[0]}")
+
+        # Includes the total so a page read before new files arrived can never
+        # be served (or stored) under the newer version
+        cache_key = (total_items, page, posts_per_page)
+        with self._page_cache_lock:
+            cached = self._page_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Fetching page {page}, total items: {total_items}")
 
         total_pages = (total_items + posts_per_page - 1) // posts_per_page
+        _, end_number = self._page_range(page, posts_per_page, total_items)
 
-        return {
-            "data": data,
+        data = self._load_page(
+            cache_key,
+            f"page:{total_items}:{page}:{posts_per_page}",
+            self._page_cursor(page, posts_per_page, total_items)
+        )
+        return self._cache_result(cache_key, {
             "total_items": total_items,
             "total_pages": total_pages,
-            "current_page": page
+            "current_page": page,
+            "data": data,
+            # Keyset token for the following page: ?after=<next_cursor>. The
+            # range ends at end_number however many files gaps left in it
+            "next_cursor": end_number if end_number > 1 else None
+        })
+
+    def _load_page(self, cache_key, shared_key, cursor):
+        """Read a page's documents from the shared Redis cache or MongoDB"""
+        shared = self._shared_get(shared_key)
+        if shared is not None:
+            return [RawBSONDocument(raw) for raw in shared]
+
+        data = list(cursor)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Found {len(data)} documents for {cache_key}")
+        self._shared_set(shared_key, [doc.raw for doc in data], self._page_cache.ttl)
+        return data
+
+    def _cache_result(self, cache_key, result):
+        """Store a result in the local page cache and return it"""
+        with self._page_cache_lock:
+            self._page_cache[cache_key] = result
+        return result
+
+    def _shared_get(self, key):
+        """Read a value from the shared Redis cache, if one is configured"""
+        if self._redis is None:
+            return None
+        try:
+            packed = self._redis.get(key)
+        except redis.RedisError as e:
+            logger.warning(f"Redis get failed for {key}: {str(e)}")
+            return None
+        return msgpack.unpackb(packed) if packed is not None else None
+
+    def _shared_get_with_ttl(self, key):
+        """Read a value and its remaining TTL in seconds from the shared Redis cache"""
+        if self._redis is None:
+            return None, None
+        try:
+            packed, ttl_ms = self._redis.pipeline().get(key).pttl(key).execute()
+        except redis.RedisError as e:
+            logger.warning(f"Redis get failed for {key}: {str(e)}")
+            return None, None
+        if packed is None or ttl_ms < 0:
+            return None, None
+        return msgpack.unpackb(packed), ttl_ms / 1000
+
+    def _shared_set(self, key, value, ttl):
+        """Write a value to the shared Redis cache, if one is configured"""
+        if self._redis is None:
+            return
+        try:
+            self._redis.setex(key, int(ttl), msgpack.packb(value))
+        except redis.RedisError as e:
+            logger.warning(f"Redis set failed for {key}: {str(e)}")
+
+    def _files_cursor(self, file_number_filter, limit):
+        """Build the covered, newest-first query shared by both pagination modes"""
+        # batch_size matches the limit so the page comes back in the first reply
+        return (
+            self.collection.find({"file_number": file_number_filter}, _PROJECTION)
+            .sort(_NEWEST_FIRST).hint(_PAGE_INDEX)
+            .batch_size(limit).limit(limit)
+        )
+
+    def _page_range(self, page, posts_per_page, total_items):
+        """Return the (start, end) file_number range a page covers"""
+        start_number = total_items - (page - 1) * posts_per_page
+        return start_number, max(1, start_number - posts_per_page + 1)
+
+    def _page_cursor(self, page, posts_per_page, total_items):
+        """Build the ranged query for a page"""
+        # A file_number range instead of skip(): the index seek costs the same
+        # for every page, whereas skip walks all earlier entries
+        start_number, end_number = self._page_range(page, posts_per_page, total_items)
+
+        return self._files_cursor(
+            {"$gte": end_number, "$lte": start_number}, posts_per_page
+        )
+
+    def explain_page(self, page, posts_per_page):
+        """Explain the page query and report whether it was covered by the index"""
+        self._ensure_connection()
+
+        raw_explain = self._page_cursor(page, posts_per_page, self._get_total_count()).explain()
+        explain = decode(raw_explain.raw)
+        winning_plan = explain["queryPlanner"]["winningPlan"]
+        stats = explain["executionStats"]
+        # Slot-based engine plans nest the classic plan tree under "queryPlan"
+        stages = _plan_stages(winning_plan.get("queryPlan", winning_plan))
+
+        return {
+            "covered": "FETCH" not in stages and stats["totalDocsExamined"] == 0,
+            "stages": stages,
+            "nReturned": stats["nReturned"],
+            "totalKeysExamined": stats["totalKeysExamined"],
+            "totalDocsExamined": stats["totalDocsExamined"],
+            "executionTimeMillis": stats["executionTimeMillis"],
+            "winningPlan": winning_plan
         }
 
-    @with_retry(max_retries=3, delay=1)
-    def _get_total_count(self):
-        """Get total count with caching"""
+    def fetch_files_after(self, after_file_number, posts_per_page):
+        """Fetch the files that come after a given file_number (keyset pagination).
+
+        Unlike fetch_files this needs no total, so page boundaries stay correct
+        while new files are being added.
+        """
         self._ensure_connection()
-        
-        current_time = datetime.now()
-        if self._cache_time and current_time - self._cache_time < self._cache_duration:
+
+        cache_key = ("after", after_file_number, posts_per_page)
+        with self._page_cache_lock:
+            cached = self._page_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+        # One extra row tells whether another page follows without a second query
+        data = self._load_page(
+            cache_key,
+            f"after:{after_file_number}:{posts_per_page}",
+            self._files_cursor({"$lt": after_file_number}, posts_per_page + 1)
+        )
+        has_more = len(data) > posts_per_page
+        data = data[:posts_per_page]
+        return self._cache_result(cache_key, {
+            "after": after_file_number,
+            "data": data,
+            "next_cursor": data[-1]["file_number"] if has_more else None
+        })
+
+    def _get_total_count(self):
+        """Get total count with caching (callers ensure the connection)"""
+        # While the refresher runs the cached value is always current enough;
+        # only the first call, or a stale cache without a refresher, queries
+        refresher_alive = self._refresher is not None and self._refresher.is_alive()
+        if self._latest_number is not None and (
+            refresher_alive or time.monotonic() < self._cache_deadline
+        ):
             return self._latest_number
-        
-        count = self.collection.count_documents({})
+
+        # A first call may take another worker's value from Redis; later
+        # refreshes always ask MongoDB so they never adopt a stale copy
+        return self._refresh_total_count(use_shared=self._latest_number is None)
+
+    def _refresh_total_count(self, use_shared=False):
+        now = time.monotonic()
+        deadline = now + self._cache_duration
+        count = None
+        if use_shared:
+            count, ttl = self._shared_get_with_ttl("files:latest")
+            if count is not None:
+                # Another worker read it up to _cache_duration ago; keep it
+                # only for what is left of that, not a fresh interval
+                deadline = now + ttl
+        # Page ranges are counted down from the highest file_number, so read it
+        # from the tip of the descending index rather than counting documents;
+        # it stays exact even if numbering has gaps
+        if count is None:
+            latest = self.collection.find_one(
+                {}, _LATEST_PROJECTION, sort=_NEWEST_FIRST
+            )
+            count = latest["file_number"] if latest else 0
+            self._shared_set("files:latest", count, self._cache_duration)
+        if count != self._latest_number:
+            # New files shift every page boundary, so drop the cached pages
+            with self._page_cache_lock:
+                self._page_cache.clear()
         self._latest_number = count
-        self._cache_time = current_time
+        self._cache_deadline = deadline
         return count
+
+
+def _plan_stages(plan):
+    """Flatten an explain plan tree into its stage names, outermost first"""
+    stages = [plan["stage"]]
+    children = plan.get("inputStages", [])
+    if "inputStage" in plan:
+        children = [plan["inputStage"]] + children
+    for child in children:
+        stages.extend(_plan_stages(child))
+    return stages
+
+
+_db = None
+_db_lock = threading.Lock()
+
+def get_database():
+    """Return the process-wide Database instance"""
+    global _db
+    if _db is None:
+        with _db_lock:
+            if _db is None:
+                _db = Database()
+    return _db
+
+def _reset_after_fork():
+    # The parent's client, caches and refresher thread are unusable in a forked
+    # child, so let it build its own instance on first use. The parent's client
+    # is not closed here since its sockets still belong to the parent.
+    global _db, _db_lock
+    _db = None
+    _db_lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+if __name__ == "__main__":
+    # One-shot bootstrap step: python -m src.database
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO)
+    get_database().bootstrap()
@@ -81,6 +81,38 @@ function createFileCard(file, index) {
     return fileCard;
 }
 
+function renderFiles(data, page) {
+    const container = document.getElementById('files-container');
+    container.innerHTML = '';
+    
+    if (!data.data || data.data.length === 0) {
+        container.innerHTML = '<div class="no-files">No files found</div>';
+        return;
+    }
+
+    // Create and append all cards first
+    data.data.forEach((file, index) => {
+        const fileCard = createFileCard(file, index);
+        container.appendChild(fileCard);
+    });
+
+    // Start observing all lazy images
+    container.querySelectorAll('.lazy-image').forEach(img => {
+        imageObserver.observe(img);
+    });
+
+    // Update pagination controls
+    document.getElementById('prev-page').disabled = page <= 1;
+    document.getElementById('next-page').disabled = page >= data.total_pages;
+    document.getElementById('page-info').textContent = `Page ${page} of ${data.total_pages}`;
+    currentPage = page;
+    
+    // Update URL without refreshing
+    const url = new URL(window.location);
+    url.searchParams.set('page', page);
+    window.history.pushState({}, '', url);
+}
+
 async function loadFiles(page) {
     if (isLoading) return;
     
@@ -95,35 +127,7 @@ async function loadFiles(page) {
         const response = await fetch(`/files?page=${page}`);
         const data = await response.json();
         
-        const container = document.getElementById('files-container');
-        container.innerHTML = '';
-        
-        if (!data.data || data.data.length === 0) {
-            container.innerHTML = '<div class="no-files">No files found</div>';
-            return;
-        }
-
-        // Create and append all cards first
-        data.data.forEach((file, index) => {
-            const fileCard = createFileCard(file, index);
-            container.appendChild(fileCard);
-        });
-
-        // Start observing all lazy images
-        container.querySelectorAll('.lazy-image').forEach(img => {
-            imageObserver.observe(img);
-        });
-
-        // Update pagination controls
-        document.getElementById('prev-page').disabled = page <= 1;
-        document.getElementById('next-page').disabled = page >= data.total_pages;
-        document.getElementById('page-info').textContent = `Page ${page} of ${data.total_pages}`;
-        currentPage = page;
-        
-        // Update URL without refreshing
-        const url = new URL(window.location);
-        url.searchParams.set('page', page);
-        window.history.pushState({}, '', url);
+        renderFiles(data, page);
         
     } catch (error) {
         console.error('Error loading files:', error);
@@ -158,8 +162,16 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     });
 
-    // Load initial page
+    // Load initial page, using the data inlined by the server when available
     const params = new URLSearchParams(window.location.search);
     const initialPage = parseInt(params.get('page')) || 1;
+    const bootstrapElement = document.getElementById('bootstrap-data');
+    if (bootstrapElement) {
+        const bootstrapData = JSON.parse(bootstrapElement.textContent);
+        if (bootstrapData.current_page === initialPage) {
+            renderFiles(bootstrapData, initialPage);
+            return;
+        }
+    }
     loadFiles(initialPage);
 });
\ No newline at end of file